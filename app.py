@@ -1,13 +1,26 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import numpy as np
 import rasterio
-from rasterio.enums import Resampling
+from rasterio.warp import transform_bounds, transform_geom
+from rasterio.windows import from_bounds
+from rasterio.features import rasterize
+from rasterio.transform import Affine
 from pystac_client import Client
 import planetary_computer as pc
 import leafmap.foliumap as leafmap
 from shapely.geometry import shape
-import json
+import orjson
+import hashlib
+import uuid
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlparse
 import pandas as pd
+import altair as alt
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
 
 # ==================================================
 # PAGE CONFIG
@@ -44,160 +57,471 @@ with st.sidebar:
 # ==================================================
 # LOAD CITY GEOJSON & AUTO BBOX
 # ==================================================
-@st.cache_data
+# Boundaries are read-only once loaded, so share one parsed copy per file
+# instead of unpickling it on every rerun
+@st.cache_resource
 def load_city(path):
-    with open(path) as f:
-        data = json.load(f)
-
-    coords = []
-    for feat in data["features"]:
-        geom = feat["geometry"]
-        if geom["type"] == "Polygon":
-            coords += geom["coordinates"][0]
-        else:
-            coords += geom["coordinates"][0][0]
-
-    lons = [c[0] for c in coords]
-    lats = [c[1] for c in coords]
-    bbox = [min(lons), min(lats), max(lons), max(lats)]
+    data = orjson.loads(Path(path).read_bytes())
+
+    bounds = np.array([shape(feat["geometry"]).bounds for feat in data["features"]])
+    minx, miny = bounds[:, :2].min(axis=0)
+    maxx, maxy = bounds[:, 2:].max(axis=0)
+    # Snapped outward to 0.001° (~100 m) and kept as plain floats, so the
+    # cache keys downstream don't hinge on float noise in the boundary file
+    bbox = (
+        float(np.floor(minx * 1000) / 1000), float(np.floor(miny * 1000) / 1000),
+        float(np.ceil(maxx * 1000) / 1000), float(np.ceil(maxy * 1000) / 1000),
+    )
 
     return data, bbox
 
+# ==================================================
+# INDEX KERNELS
+# ==================================================
+# Float64 literals would promote the whole kernel to double precision
+EPS = np.float32(1e-10)
+
+# Index change is stored as int8 hundredths, floored and clipped to
+# [-1.27, 1.27]. Flooring keeps "change < -t" equivalent to "q < -T" and
+# "change > t" to "q >= T" for thresholds on the 0.01 grid, which the
+# sliders (0.1-0.4 in 0.05 steps) always are. -128 is reserved for pixels
+# with no data in either scene: 0 reflectance is both Sentinel-2's nodata
+# and the fill for reads past the tile edge.
+CHANGE_SCALE = np.float32(100)
+NODATA = -128
+
+def to_change_units(thresh):
+    return int(round(thresh * CHANGE_SCALE))
+
+# Change in normalised difference (pos - neg) / (pos + neg) between two scenes,
+# fused into one pass with no temporary arrays and quantised on write. Before
+# and after share a grid (checked by the caller); pos and neg bands can differ
+# by a pixel of window rounding, so only their overlap is used.
+# Serial on purpose: Streamlit calls this from concurrent session threads,
+# which Numba's fallback (workqueue) threading layer aborts on, and rasters
+# of at most ~1000x500 px gain little from threads anyway.
+@njit(fastmath=True, cache=True)
+def nd_change(pos_b, neg_b, pos_a, neg_a):
+    h = min(pos_b.shape[0], neg_b.shape[0])
+    w = min(pos_b.shape[1], neg_b.shape[1])
+    out = np.empty((h, w), dtype=np.int8)
+    for i in range(h):
+        for j in range(w):
+            pb, nb = pos_b[i, j], neg_b[i, j]
+            pa, na = pos_a[i, j], neg_a[i, j]
+            if pb == 0 or nb == 0 or pa == 0 or na == 0:
+                out[i, j] = NODATA
+                continue
+            d = (pa - na) / (pa + na + EPS) - (pb - nb) / (pb + nb + EPS)
+            out[i, j] = min(127, max(-127, np.floor(d * CHANGE_SCALE)))
+    return out
+
+# Per-ward percentage of pixels with lo <= value < hi, in one pass over a
+# ward-id raster (0 = outside every ward); NODATA pixels count for neither
+@njit(cache=True)
+def zonal_percent(labels, arr, lo, hi, n):
+    hits = np.zeros(n + 1, dtype=np.int64)
+    totals = np.zeros(n + 1, dtype=np.int64)
+    h = min(labels.shape[0], arr.shape[0])
+    w = min(labels.shape[1], arr.shape[1])
+    for i in range(h):
+        for j in range(w):
+            v = arr[i, j]
+            if v == NODATA:
+                continue
+            k = labels[i, j]
+            totals[k] += 1
+            if lo <= v < hi:
+                hits[k] += 1
+    out = np.zeros(n)
+    for k in range(1, n + 1):
+        if totals[k]:
+            out[k - 1] = hits[k] * 100.0 / totals[k]
+    return out
+
+
+# Compile (or load from Numba's on-disk cache) once per server process,
+# so the first user request doesn't pay the JIT cost
+@st.cache_resource
+def warm_kernels():
+    # compute_change hands nd_change read-only bands
+    z = np.zeros((4, 4), dtype=np.float32)
+    z.flags.writeable = False
+    change = nd_change(z, z, z, z)
+    # Ward analytics run on the read-only arrays shared by change_arrays
+    # and ward_labels
+    labels = np.zeros((4, 4), dtype=np.int32)
+    change.flags.writeable = labels.flags.writeable = False
+    zonal_percent(labels, change, 20, 128, 1)
+
 # ==================================================
 # SATELLITE PROCESSING (NDVI / NDBI)
 # ==================================================
-@st.cache_data(show_spinner=False)
-def compute_change(bbox, y1, y2):
-    catalog = Client.open("https://planetarycomputer.microsoft.com/api/stac/v1")
-
-    def scene(year):
-        search = catalog.search(
-            collections=["sentinel-2-l2a"],
-            bbox=bbox,
-            datetime=f"{year}-01-01/{year}-12-31",
-            query={"eo:cloud_cover": {"lt": 10}},
-        )
-        return pc.sign(list(search.items())[0])
+# GDAL options for HTTP range reads against cloud-optimised GeoTIFFs
+GDAL_ENV = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_USE_HEAD": "NO",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif",
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": "536870912",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_VERSION": "2",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+}
+
+# Part of every persisted key for band reads and change rasters. Those keys
+# otherwise only cover the inputs (and, for compute_change, its own source,
+# not the kernels it calls), so bump this whenever reading, nd_change or the
+# NODATA/CHANGE_SCALE encoding change meaning.
+CACHE_VERSION = 2
+
+# Downsampled band windows are kept on local disk so a scene shared by two
+# year pairs (e.g. 2023 in 2022→2023 and 2023→2024) is only downloaded once
+BAND_CACHE_DIR = Path(".cache") / "bands"
+BAND_CACHE_MAX_FILES = 64   # 8 reads per year pair -> ~8 city/year pairs
+
+# Band reads run concurrently, so only one thread prunes at a time
+BAND_CACHE_LOCK = threading.Lock()
+
+def evict_bands():
+    # LRU by mtime (hits touch their file); drop the oldest beyond the cap.
+    # Files can vanish mid-scan (another process pruning), and on Windows a
+    # file memory-mapped by another session can't be unlinked; skip both.
+    with BAND_CACHE_LOCK:
+        files = []
+        for f in BAND_CACHE_DIR.glob("*.npy"):
+            try:
+                files.append((f.stat().st_mtime, f))
+            except OSError:
+                pass
+        files.sort()
+        for _, f in files[:-BAND_CACHE_MAX_FILES]:
+            try:
+                f.unlink(missing_ok=True)
+            except OSError:
+                pass
+
+def cached_band(href, bbox, scale, fetch):
+    # Signed URLs rotate with each SAS token; key on the blob path only
+    key = hashlib.sha1(
+        f"{CACHE_VERSION}|{urlparse(href).path}|{bbox}|{scale}".encode()
+    ).hexdigest()
+    path = BAND_CACHE_DIR / f"{key}.npy"
+    try:
+        arr = np.load(path, mmap_mode="r")
+    except (FileNotFoundError, ValueError):
+        pass
+    else:
+        try:
+            path.touch()
+        except OSError:
+            pass
+        return arr
+
+    arr = fetch()
+    BAND_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{key}.{uuid.uuid4().hex}.tmp")
+    with open(tmp, "wb") as f:
+        np.save(f, arr)
+    tmp.replace(path)
+    evict_bands()
+    return arr
+
+@st.cache_resource
+def stac_client():
+    return Client.open("https://planetarycomputer.microsoft.com/api/stac/v1")
+
+
+# The best scene for a year pair rarely changes, so the search result is
+# kept on disk (unsigned) and survives restarts. It is redone weekly in case
+# Planetary Computer reprocesses or moves the assets; st.cache_data ignores
+# ttl when persisting to disk, so the week number is part of the key instead.
+# Streamlit never deletes persisted entries, so old weeks' lookups (a few
+# hrefs each) pile up in .streamlit/cache until it is cleared by hand.
+SCENE_REFRESH = 7 * 24 * 3600
+
+@st.cache_data(show_spinner=False, persist="disk")
+def find_scenes(bbox, y1, y2, week):
+    # One search over both years, clearest scenes first. Both scenes must come
+    # from the same MGRS tile so they share one pixel grid; the pair chosen is
+    # the tile with the lowest combined cloud cover that has a scene in each
+    # year (its first hit per year is its clearest).
+    search = stac_client().search(
+        collections=["sentinel-2-l2a"],
+        bbox=list(bbox),
+        datetime=f"{y1}-01-01/{y2}-12-31",
+        query={"eo:cloud_cover": {"lt": 10}},
+        sortby=[{"field": "eo:cloud_cover", "direction": "asc"}],
+    )
+    tiles = {}
+    best, best_cover = None, float("inf")
+    for item in search.items():
+        cover = item.properties["eo:cloud_cover"]
+        # Any pair not yet complete costs at least this item's cover plus the
+        # clearest single scene still waiting for its other year (or this
+        # item's cover again); once that can't beat the best pair, stop paging
+        waiting = [
+            next(iter(scenes.values())).properties["eo:cloud_cover"]
+            for scenes in tiles.values() if len(scenes) == 1
+        ]
+        if cover + min(waiting + [cover]) >= best_cover:
+            break
+
+        scenes = tiles.setdefault(item.properties["s2:mgrs_tile"], {})
+        scenes.setdefault(item.datetime.year, item)
+        if len(scenes) == 2:
+            total = sum(s.properties["eo:cloud_cover"] for s in scenes.values())
+            if total < best_cover:
+                best, best_cover = scenes, total
+
+    if best is None:
+        raise LookupError(f"No MGRS tile over {bbox} has clear scenes in both {y1} and {y2}")
+
+    def hrefs(year):
+        return {band: best[year].assets[band].href for band in ("B04", "B08", "B11")}
+
+    return hrefs(y1), hrefs(y2)
+
+
+# Planetary Computer SAS tokens expire after ~1 h, so signed URLs are kept for 30 min
+@st.cache_data(show_spinner=False, ttl=1800)
+def scene_hrefs(bbox, y1, y2):
+    return tuple(
+        {band: pc.sign(href) for band, href in scene.items()}
+        for scene in find_scenes(bbox, y1, y2, int(time.time() // SCENE_REFRESH))
+    )
 
-    before = scene(y1)
-    after = scene(y2)
 
-    def read(band, item, scale):
-        with rasterio.open(item.assets[band].href) as src:
-            return src.read(
-                1,
-                out_shape=(src.height // scale, src.width // scale),
-                resampling=Resampling.average,
-            ).astype("float32")
+# max_entries only bounds the in-memory copy: the .memo files on disk are
+# never evicted. Per CACHE_VERSION they are bounded by the inputs (3 cities x
+# 7 year pairs, around 1 MB each), but superseded versions stay in
+# .streamlit/cache until it is cleared by hand.
+@st.cache_data(show_spinner=False, persist="disk", max_entries=32)
+def compute_change(bbox, y1, y2, version):
+    before, after = scene_hrefs(bbox, y1, y2)
+
+    def open_scaled(href, scale):
+        # Use the coarsest COG overview that is not coarser than `scale`
+        # (overview_level n is the n-th factor); fetch averages whatever
+        # factor is left
+        with rasterio.open(href) as src:
+            usable = [f for f in src.overviews(1) if f <= scale]
+        factor = usable[-1] if usable else 1
+        extra = {"overview_level": len(usable) - 1} if usable else {}
+        return rasterio.open(href, **extra), scale // factor
+
+    def bbox_window(src, rest):
+        # City bbox window in the scene's own CRS, its output shape (whole
+        # rest x rest blocks), and the affine transform of that output grid
+        bounds = transform_bounds("EPSG:4326", src.crs, *bbox)
+        window = from_bounds(*bounds, transform=src.transform)
+        window = window.round_offsets().round_lengths()
+        out_shape = (max(1, int(window.height) // rest), max(1, int(window.width) // rest))
+        transform = src.window_transform(window) * Affine.scale(rest)
+        return window, out_shape, transform
+
+    def fetch(href, scale):
+        # Only tiles covering the city bbox are fetched. The window is read at
+        # the overview's own resolution: a boundless read from an overview
+        # with a smaller out_shape returns nearest-neighbour samples, not
+        # averages, so the remaining factor is block-averaged here, leaving
+        # out 0 (nodata and off-tile fill)
+        with rasterio.Env(**GDAL_ENV):
+            src, rest = open_scaled(href, scale)
+            with src:
+                window, (h, w), _ = bbox_window(src, rest)
+                arr = src.read(
+                    1,
+                    window=window,
+                    boundless=True,
+                    fill_value=0,
+                    out_dtype="float32",
+                )
+        if rest == 1:
+            return arr
+        blocks = arr[:h * rest, :w * rest].reshape(h, rest, w, rest)
+        valid = np.count_nonzero(blocks, axis=(1, 3))
+        return np.divide(
+            blocks.sum(axis=(1, 3)), valid,
+            out=np.zeros((h, w), dtype=np.float32), where=valid > 0,
+        )
 
-    red_b, nir_b = read("B04", before, 4), read("B08", before, 4)
-    red_a, nir_a = read("B04", after, 4), read("B08", after, 4)
-    swir_b, swir_a = read("B11", before, 8), read("B11", after, 8)
+    def grid(href, scale):
+        # CRS (as WKT) and transform of a band's output grid, header-only
+        with rasterio.Env(**GDAL_ENV):
+            src, rest = open_scaled(href, scale)
+            with src:
+                _, _, transform = bbox_window(src, rest)
+                return src.crs.to_wkt(), tuple(transform)[:6]
+
+    def read(band, hrefs, scale):
+        href = hrefs[band]
+        arr = cached_band(href, bbox, scale, lambda: fetch(href, scale))
+        # Cache hits are read-only memmaps; make fresh reads match, so
+        # nd_change only ever sees (and warm_kernels compiles) one signature
+        arr.flags.writeable = False
+        return arr
+
+    # NDVI uses the 10 m bands at 1/4 (40 m). NDBI needs NIR on SWIR's grid:
+    # B11 is 20 m, so 1/8 of it is 160 m, matched by reading B08 at 1/16.
+    # Band reads are network-bound; rasterio releases the GIL while fetching.
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        # Ward labels are burned onto these grids; the first band of each
+        # index (B04 at 1/4, B11 at 1/8) sets the grid's origin and pixel size
+        ndvi_grid = pool.submit(grid, after["B04"], 4)
+        ndbi_grid = pool.submit(grid, after["B11"], 8)
+        red_b, nir_b, nir16_b, swir_b, red_a, nir_a, nir16_a, swir_a = pool.map(
+            lambda args: read(*args),
+            [
+                ("B04", before, 4), ("B08", before, 4), ("B08", before, 16), ("B11", before, 8),
+                ("B04", after, 4), ("B08", after, 4), ("B08", after, 16), ("B11", after, 8),
+            ],
+        )
 
-    ndvi_change = (nir_a - red_a) / (nir_a + red_a + 1e-10) - (
-        (nir_b - red_b) / (nir_b + red_b + 1e-10)
-    )
+    # Same tile, same window: anything else would compare different ground
+    for b, a in ((red_b, red_a), (nir_b, nir_a), (nir16_b, nir16_a), (swir_b, swir_a)):
+        if b.shape != a.shape:
+            raise ValueError(f"Scene grids differ between {y1} and {y2}: {b.shape} vs {a.shape}")
 
-    ndbi_change = (swir_a - nir_a[:swir_a.shape[0], :swir_a.shape[1]]) / (
-        swir_a + nir_a[:swir_a.shape[0], :swir_a.shape[1]] + 1e-10
-    ) - (
-        (swir_b - nir_b[:swir_b.shape[0], :swir_b.shape[1]]) /
-        (swir_b + nir_b[:swir_b.shape[0], :swir_b.shape[1]] + 1e-10)
-    )
+    ndvi_change = nd_change(nir_b, red_b, nir_a, red_a)
+    ndbi_change = nd_change(swir_b, nir16_b, swir_a, nir16_a)
 
-    return ndvi_change, ndbi_change
+    return ndvi_change, ndbi_change, ndvi_grid.result(), ndbi_grid.result()
 
-# ==================================================
-# SAFE PERCENT
-# ==================================================
-def safe_percent(mask):
-    return (np.count_nonzero(mask) / mask.size) * 100 if mask.size else 0.0
+# compute_change's disk cache hands every rerun its own unpickled copy;
+# keep one copy per (bbox, years) in memory, shared by all sessions.
+# The arrays are marked read-only because they are shared.
+@st.cache_resource(max_entries=8)
+def change_arrays(bbox, y1, y2):
+    ndvi, ndbi, ndvi_grid, ndbi_grid = compute_change(bbox, y1, y2, CACHE_VERSION)
+    ndvi.flags.writeable = ndbi.flags.writeable = False
+    return ndvi, ndbi, ndvi_grid, ndbi_grid
 
 # ==================================================
 # ROBUST WARD NAME EXTRACTOR
 # ==================================================
-def get_ward_name(props):
-    for key in [
-        "ward_name", "WARD_NAME", "wardname", "division",
-        "ward_no", "WARD_NO", "wardnumber", "ward_id", "Ward_No"
-    ]:
-        if key in props and props[key] not in [None, ""]:
-            return str(props[key])
-
-    for k, v in props.items():
+WARD_NAME_KEYS = (
+    "ward_name", "WARD_NAME", "wardname", "division",
+    "ward_no", "WARD_NO", "wardnumber", "ward_id", "Ward_No"
+)
+
+# All wards in a file share one schema, so pick the name property once
+def ward_name_key(props):
+    for key in WARD_NAME_KEYS:
+        if props.get(key) not in [None, ""]:
+            return key
+
+    for k in props:
         if "ward" in k.lower():
-            return str(v)
+            return k
 
-    return "Unknown"
+    return None
+
+def get_ward_name(props, key):
+    value = props.get(key) if key else None
+    return "Unknown" if value in [None, ""] else str(value)
 
 # ==================================================
 # WARD ANALYTICS + POPUPS
 # ==================================================
-def analyze_wards(boundary, ndvi, ndbi, bbox):
-    hv, wv = ndvi.shape
-    hu, wu = ndbi.shape
-
-    rows = []
-    features = []
-
-    for feat in boundary["features"]:
-        poly = shape(feat["geometry"])
-        minx, miny, maxx, maxy = poly.bounds
+# Ward ids burned into the change raster's grid: the lon/lat polygons are
+# projected into the scene's CRS and rasterised on the read window's
+# transform. Depends only on the city and grid, so it's built once and shared.
+@st.cache_resource(max_entries=8)
+def ward_labels(path, grid, out_shape):
+    boundary, _ = load_city(path)
+    crs, transform = grid
+    labels = rasterize(
+        (
+            (transform_geom("EPSG:4326", crs, feat["geometry"]), i + 1)
+            for i, feat in enumerate(boundary["features"])
+        ),
+        out_shape=out_shape,
+        transform=Affine(*transform),
+        fill=0,
+        dtype="int32",
+    )
+    labels.flags.writeable = False
+    return labels
 
-        x0v = int((minx - bbox[0]) / (bbox[2] - bbox[0]) * wv)
-        x1v = int((maxx - bbox[0]) / (bbox[2] - bbox[0]) * wv)
-        y0v = int((miny - bbox[1]) / (bbox[3] - bbox[1]) * hv)
-        y1v = int((maxy - bbox[1]) / (bbox[3] - bbox[1]) * hv)
+def ward_metrics(path, ndvi, ndbi, ndvi_grid, ndbi_grid):
+    boundary, _ = load_city(path)
+    features = boundary["features"]
+    n = len(features)
 
-        x0u = int((minx - bbox[0]) / (bbox[2] - bbox[0]) * wu)
-        x1u = int((maxx - bbox[0]) / (bbox[2] - bbox[0]) * wu)
-        y0u = int((miny - bbox[1]) / (bbox[3] - bbox[1]) * hu)
-        y1u = int((maxy - bbox[1]) / (bbox[3] - bbox[1]) * hu)
+    # Exact polygon masks rather than ward bounding boxes, one pass per raster
+    veg_loss_pct = zonal_percent(
+        ward_labels(path, ndvi_grid, ndvi.shape), ndvi, NODATA + 1, -to_change_units(ndvi_thresh), n
+    )
+    urban_pct = zonal_percent(
+        ward_labels(path, ndbi_grid, ndbi.shape), ndbi, to_change_units(ndbi_thresh), 128, n
+    )
 
-        zone_ndvi = ndvi[max(0,y0v):min(hv,y1v), max(0,x0v):min(wv,x1v)]
-        zone_ndbi = ndbi[max(0,y0u):min(hu,y1u), max(0,x0u):min(wu,x1u)]
+    name_key = ward_name_key(features[0].get("properties") or {}) if n else None
 
-        veg_loss = safe_percent(zone_ndvi < -ndvi_thresh)
-        urban = safe_percent(zone_ndbi > ndbi_thresh)
+    return pd.DataFrame({
+        "Ward": [get_ward_name(feat.get("properties") or {}, name_key) for feat in features],
+        "Vegetation Loss (%)": veg_loss_pct,
+        "Urban Expansion (%)": urban_pct,
+    })
 
-        props = feat.get("properties", {})
-        ward_name = get_ward_name(props)
+# Popup HTML is only rebuilt when the metrics' inputs change; the result is
+# shared read-only, like the boundary it is built from
+@st.cache_resource(max_entries=16)
+def ward_geojson(path, year, ndvi_thresh, ndbi_thresh, _ward_df):
+    boundary, _ = load_city(path)
+    features = []
 
-        rows.append({
-            "Ward": ward_name,
-            "Vegetation Loss (%)": veg_loss,
-            "Urban Expansion (%)": urban,
+    for feat, ward_name, veg_loss, urban in zip(
+        boundary["features"],
+        _ward_df["Ward"],
+        _ward_df["Vegetation Loss (%)"],
+        _ward_df["Urban Expansion (%)"],
+    ):
+        # Copy rather than mutate: the boundary is shared across sessions
+        features.append({
+            **feat,
+            "properties": {
+                **(feat.get("properties") or {}),
+                "popup": (
+                    f"<b>Ward:</b> {ward_name}<br>"
+                    f"<b>Vegetation Loss:</b> {veg_loss:.2f}%<br>"
+                    f"<b>Urban Expansion:</b> {urban:.2f}%"
+                ),
+            },
         })
 
-        feat["properties"]["popup"] = (
-            f"<b>Ward:</b> {ward_name}<br>"
-            f"<b>Vegetation Loss:</b> {veg_loss:.2f}%<br>"
-            f"<b>Urban Expansion:</b> {urban:.2f}%"
-        )
-
-        features.append(feat)
-
-    return pd.DataFrame(rows), {"type": "FeatureCollection", "features": features}
+    return {"type": "FeatureCollection", "features": features}
 
 # ==================================================
 # RUN PIPELINE
 # ==================================================
-boundary, bbox = load_city(CITY_FILES[city])
-ndvi_change, ndbi_change = compute_change(bbox, year - 1, year)
-ward_df, ward_geo = analyze_wards(boundary, ndvi_change, ndbi_change, bbox)
+warm_kernels()
+_, bbox = load_city(CITY_FILES[city])
+ndvi_change, ndbi_change, ndvi_grid, ndbi_grid = change_arrays(bbox, year - 1, year)
+ward_df = ward_metrics(CITY_FILES[city], ndvi_change, ndbi_change, ndvi_grid, ndbi_grid)
+ward_geo = ward_geojson(CITY_FILES[city], year, ndvi_thresh, ndbi_thresh, ward_df)
 
 # ==================================================
 # MAP (OPENSTREETMAP DEFAULT)
 # ==================================================
-m = leafmap.Map(
-    center=[(bbox[1] + bbox[3]) / 2, (bbox[0] + bbox[2]) / 2],
-    zoom=11,
-    tiles="OpenStreetMap.Mapnik",
-)
+# Rendered HTML depends only on the sidebar inputs, so cache it on those
+# rather than rebuilding the folium map and re-serialising wards each rerun
+@st.cache_data(show_spinner=False, max_entries=16)
+def ward_map_html(city, year, ndvi_thresh, ndbi_thresh, bbox, _ward_geo):
+    m = leafmap.Map(
+        center=[(bbox[1] + bbox[3]) / 2, (bbox[0] + bbox[2]) / 2],
+        zoom=11,
+        tiles="OpenStreetMap.Mapnik",
+    )
+    m.add_geojson(_ward_geo, layer_name="Wards (Click for details)")
+    m.add_layer_control()
+    return m.to_html()
 
-m.add_geojson(ward_geo, layer_name="Wards (Click for details)")
-m.add_layer_control()
-m.to_streamlit(height=420)
+components.html(
+    ward_map_html(city, year, ndvi_thresh, ndbi_thresh, bbox, ward_geo),
+    height=420,
+)
 
 # ==================================================
 # KPIs
@@ -242,29 +566,46 @@ st.dataframe(urban_hotspots)
 # ==================================================
 st.subheader("📈 Ward-wise Charts")
 
-top_veg = ward_df.sort_values("Vegetation Loss (%)", ascending=False).head(10)
-top_urban = ward_df.sort_values("Urban Expansion (%)", ascending=False).head(10)
+# Built once per ward table instead of on every rerun
+@st.cache_data
+def top10_chart(df, column):
+    top = df.sort_values(column, ascending=False).head(10)
+    return alt.Chart(top).mark_bar().encode(
+        x=alt.X("Ward:N", sort="-y"),
+        y=alt.Y(field=column, type="quantitative"),
+        tooltip=["Ward", alt.Tooltip(field=column, type="quantitative", format=".2f")],
+    )
 
 st.markdown("### Vegetation Loss by Ward (Top 10)")
-st.bar_chart(top_veg.set_index("Ward")["Vegetation Loss (%)"])
+st.altair_chart(top10_chart(ward_df, "Vegetation Loss (%)"), width="stretch")
 
 st.markdown("### Urban Expansion by Ward (Top 10)")
-st.bar_chart(top_urban.set_index("Ward")["Urban Expansion (%)"])
+st.altair_chart(top10_chart(ward_df, "Urban Expansion (%)"), width="stretch")
 
 # ==================================================
 # DOWNLOAD
 # ==================================================
 st.subheader("⬇️ Download")
 
+# Encoded once per set of sidebar inputs, not on every rerun
+@st.cache_data(show_spinner=False, max_entries=16)
+def export_bytes(city, year, ndvi_thresh, ndbi_thresh, _ward_df, _ward_geo):
+    return _ward_df.to_csv(index=False).encode(), orjson.dumps(_ward_geo)
+
+csv_bytes, geojson_bytes = export_bytes(
+    city, year, ndvi_thresh, ndbi_thresh, ward_df, ward_geo
+)
+
 st.download_button(
     "Download Ward Analytics (CSV)",
-    ward_df.to_csv(index=False),
+    csv_bytes,
     "ward_analytics.csv",
+    "text/csv",
 )
 
 st.download_button(
     "Download Ward GeoJSON",
-    json.dumps(ward_geo),
+    geojson_bytes,
     "ward_analysis.geojson",
     "application/geo+json",
 )